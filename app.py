@@ -1,50 +1,239 @@
 import streamlit as st
 import folium
 from folium.features import DivIcon
+from folium.plugins import FastMarkerCluster
 from streamlit_folium import st_folium
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import osmnx as ox
 import networkx as nx
+import igraph
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
+from pyproj import Geod
 import altair as alt
-import warnings
+import copy
+import diskcache
+import hashlib
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(layout="wide", page_title="Walking Catchment Analyzer")
 
+MAX_WALK_TIME_MIN = 15
+# Above this many visible POIs the map switches to client-side clustering
+FAST_CLUSTER_THRESHOLD = 2000
+# Max deviation (metres) allowed when simplifying street geometries for display
+EDGE_SIMPLIFY_TOLERANCE_M = 2.0
+
+# Persist raw Overpass HTTP responses across restarts and workers
+ox.settings.use_cache = True
+ox.settings.cache_folder = ".osmnx_cache"
+
+_GEOD = Geod(ellps="WGS84")
+
 
 # --- FUNCTIONS (Cached) ---
-@st.cache_data
-def get_amenities(_polygon, tags, lat, lon):
+@st.cache_resource(show_spinner=False)
+def _osm_disk_cache():
+    return diskcache.Cache(".osm_cache")
+
+
+def _osm_cache_key(poly_wkb, tags_json):
+    return hashlib.blake2b(poly_wkb + tags_json.encode()).hexdigest()
+
+
+# Keyed on WKB bytes + canonical tag JSON so Streamlit hashes the actual query geometry
+@st.cache_data(show_spinner=False)
+def get_amenities(poly_wkb, tags_json):
+    cache = _osm_disk_cache()
+    key = _osm_cache_key(poly_wkb, tags_json)
+    cached = cache.get(key)
+    if cached is not None:
+        return gpd.read_parquet(io.BytesIO(cached))
+
     try:
-        pois = ox.features_from_polygon(_polygon, tags=tags)
-        return pois
+        pois = ox.features_from_polygon(shapely.from_wkb(poly_wkb), tags=json.loads(tags_json))
     except Exception:
         return None
 
-
-@st.cache_data
-def calculate_isochrone_network(lat, lon, walk_time_min, speed_kph=4.5):
-    dist = (walk_time_min / 60) * speed_kph * 1000 * 1.2
-    G = ox.graph_from_point((lat, lon), dist=dist, network_type="walk")
-
-    center_node = ox.distance.nearest_nodes(G, lon, lat)
-    G = ox.project_graph(G)
+    # Mixed-type OSM tag columns can't always be written to parquet; skip persisting those
+    buf = io.BytesIO()
+    try:
+        pois.to_parquet(buf)
+        cache[key] = buf.getvalue()
+    except (ValueError, TypeError, NotImplementedError):
+        pass
+    return pois
+
+
+@st.cache_resource(show_spinner=False, max_entries=4, ttl=3600)
+def _get_walk_graph(lat_round, lon_round, max_dist_m, speed_kph):
+    # Shared across walk times: sized for the slider maximum, keyed on a rounded grid.
+    # Kept in EPSG:4326; osmnx already stores edge "length" in metres.
+    # Circular query area instead of graph_from_point's bbox (~21% less ground to fetch)
+    center = gpd.GeoSeries([shapely.Point(lon_round, lat_round)], crs="EPSG:4326")
+    query_area = center.to_crs(center.estimate_utm_crs()).buffer(max_dist_m).to_crs(epsg=4326).iloc[0]
+    G = ox.graph_from_polygon(query_area, network_type="walk", simplify=True, truncate_by_edge=True)
     meters_per_minute = speed_kph * 1000 / 60
 
-    for u, v, k, data in G.edges(keys=True, data=True):
-        data["time"] = data["length"] / meters_per_minute
-
-    subgraph = nx.ego_graph(G, center_node, radius=walk_time_min, distance="time")
-    nodes_gdf, edges_gdf = ox.graph_to_gdfs(subgraph)
+    lengths = np.fromiter(
+        (d["length"] for _, _, d in G.edges(data=True)), dtype=np.float64, count=G.number_of_edges()
+    )
+    times = lengths / meters_per_minute
+    nx.set_edge_attributes(G, dict(zip(G.edges(keys=True), times.tolist())), "time")
+
+    # igraph mirror of G (contiguous node indices) for C-level Dijkstra
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    node_index = {n: i for i, n in enumerate(node_ids.tolist())}
+    ig_graph = igraph.Graph(
+        n=len(node_ids),
+        edges=[(node_index[u], node_index[v]) for u, v in G.edges()],
+        directed=True,
+        edge_attrs={"time": times.tolist()},
+    )
+    return G, ig_graph, node_index, node_ids
+
+
+def _walk_graph_around(lat, lon, speed_kph):
+    # Extra 100 m covers the offset between the click and the rounded graph centre
+    dist = (MAX_WALK_TIME_MIN / 60) * speed_kph * 1000 * 1.2 + 100
+    return _get_walk_graph(round(lat, 3), round(lon, 3), dist, speed_kph)
+
+
+@st.cache_data(show_spinner=False)
+def _reachable_nodes(lat, lon, walk_time_min, speed_kph=4.5):
+    G, ig_graph, node_index, node_ids = _walk_graph_around(lat, lon, speed_kph)
+    center_node = ox.distance.nearest_nodes(G, lon, lat)
 
-    nodes_gdf = nodes_gdf.to_crs(epsg=4326)
-    edges_gdf = edges_gdf.to_crs(epsg=4326)
+    dists = np.asarray(ig_graph.distances(source=node_index[center_node], weights="time", mode="out")[0])
+    return node_ids[dists <= walk_time_min].tolist()
 
-    # Union all nodes to create the polygon hull
-    query_polygon = nodes_gdf.union_all().convex_hull
 
-    return edges_gdf, query_polygon
+def _session_memo(slot, key, compute, max_entries=4):
+    # Plain per-session dict: no st.cache_data hashing or pickle round-trip on hits.
+    # Only the most recently used keys are kept so a session can't grow it unbounded.
+    memo = st.session_state.setdefault(slot, {})
+    if key in memo:
+        memo[key] = memo.pop(key)
+    else:
+        memo[key] = compute()
+        while len(memo) > max_entries:
+            del memo[next(iter(memo))]
+    return memo[key]
+
+
+def _isochrone_polygon(lat, lon, walk_time_min, speed_kph):
+    G = _walk_graph_around(lat, lon, speed_kph)[0]
+    reached = _reachable_nodes(lat, lon, walk_time_min, speed_kph)
+
+    # Concave hull of the reached nodes hugs the network tighter than a convex hull
+    coords = np.array([(G.nodes[n]["x"], G.nodes[n]["y"]) for n in reached])
+    return shapely.concave_hull(shapely.MultiPoint(coords), ratio=0.2)
+
+
+def _isochrone_edges(lat, lon, walk_time_min, speed_kph):
+    G = _walk_graph_around(lat, lon, speed_kph)[0]
+    reached = _reachable_nodes(lat, lon, walk_time_min, speed_kph)
+    edges_gdf = ox.graph_to_gdfs(G.subgraph(reached), nodes=False)
+
+    # Thin vertices for the map payload; degrees per metre of latitude keeps the
+    # error at or under the metre tolerance in both axes. "length" is untouched.
+    edges_gdf["geometry"] = edges_gdf.geometry.simplify(
+        EDGE_SIMPLIFY_TOLERANCE_M / 111_320, preserve_topology=False
+    )
+    return edges_gdf
+
+
+def calculate_isochrone_polygon(lat, lon, walk_time_min, speed_kph=4.5):
+    key = (round(lat, 4), round(lon, 4), walk_time_min, speed_kph)
+    return _session_memo(
+        "_iso_polygon_cache", key, lambda: _isochrone_polygon(lat, lon, walk_time_min, speed_kph)
+    )
+
+
+def calculate_isochrone_edges(lat, lon, walk_time_min, speed_kph=4.5):
+    key = (round(lat, 4), round(lon, 4), walk_time_min, speed_kph)
+    return _session_memo(
+        "_iso_edges_cache", key, lambda: _isochrone_edges(lat, lon, walk_time_min, speed_kph)
+    )
+
+
+@st.cache_data(show_spinner=False)
+def build_category_chart_spec(counts_items):
+    # Cached Vega-Lite dict, keyed on the (category, count) pairs being shown
+    chart_agg = pd.DataFrame(counts_items, columns=["Category", "Count"])
+
+    base = alt.Chart(chart_agg).encode(
+        y=alt.Y("Category", sort="-x", title=None),
+        tooltip=["Category", "Count"],
+    )
+    bars = base.mark_bar().encode(
+        x=alt.X("Count", title="Count"),
+        color=alt.Color(
+            "Category",
+            scale=alt.Scale(
+                domain=list(color_map.keys()), range=list(color_map.values())
+            ),
+            legend=None,
+        ),
+    )
+    text = base.mark_text(dx=5, align="left", color="#FFFFFF").encode(
+        x=alt.X("Count"), text="Count"
+    )
+    return (bars + text).properties(height=350).to_dict()
+
+
+def classify_pois(pois):
+    cols = pois.reindex(
+        columns=[
+            "amenity", "shop", "railway", "public_transport", "highway",
+            "healthcare", "leisure", "sport", "tourism", "office",
+        ]
+    )
+    amenity = cols["amenity"]
+    shop = cols["shop"]
+
+    # Lowest priority first, so higher-priority categories overwrite
+    cat = np.full(len(pois), "Others", dtype=object)
+    cat[cols["office"].notna().to_numpy()] = "Office"
+    cat[cols["tourism"].notna().to_numpy()] = "Tourism"
+    cat[(cols["leisure"].notna() | cols["sport"].notna()).to_numpy()] = "Leisure/Sport"
+    cat[shop.isin(['supermarket', 'convenience', 'greengrocer', 'bakery', 'market']).to_numpy()] = "Grocery"
+    cat[cols["healthcare"].notna().to_numpy()] = "Healthcare"
+    cat[amenity.isin(['clinic', 'hospital', 'pharmacy', 'doctors', 'dentist']).to_numpy()] = "Healthcare"
+    cat[amenity.eq('place_of_worship').to_numpy()] = "Worship"
+    cat[amenity.isin(['school', 'university', 'college', 'kindergarten', 'language_school']).to_numpy()] = "Education"
+    cat[(cols["public_transport"].notna() | cols["highway"].eq("bus_stop")).to_numpy()] = "Transit (Bus/Other)"
+    cat[cols["railway"].notna().to_numpy()] = _TRAIN_CAT
+
+    main_category = pd.Categorical(cat, categories=list(color_map))
+    display_name = pd.Series(main_category.astype(str), index=pois.index) + ": " + amenity.fillna("Location")
+
+    # Keep only what the app reads, as categoricals, to shrink session/cache footprint
+    return gpd.GeoDataFrame(
+        {
+            "amenity": amenity.astype("category"),
+            "main_category": main_category,
+            "display_name": display_name.astype("category"),
+        },
+        geometry=pois.geometry,
+        crs=pois.crs,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _base_map():
+    # Tile layers only; callers deepcopy, then set the centre and add per-run overlays
+    m = folium.Map(location=[0, 0], zoom_start=15, tiles=None)
+    folium.TileLayer(tiles="OpenStreetMap", name="Street Map", control=True).add_to(m)
+    folium.TileLayer(tiles="CartoDB positron", name="Light Map", control=True).add_to(m)
+    folium.TileLayer(tiles="CartoDB dark_matter", name="Dark Map", control=True).add_to(m)
+    return m
 
 
 # --- 2. SESSION STATE ---
@@ -69,6 +258,9 @@ color_map = {
     "Grocery": "#2ECC71",
     "Others": "#16A085",
 }
+# Lookup table for vectorized category -> colour mapping in the marker layer
+_COLOR_SERIES = pd.Series(color_map)
+_TRAIN_CAT = "Transit (Train/Rail)"
 
 # --- 4. PREPARE DATA ---
 res = st.session_state["analysis_results"]
@@ -78,64 +270,38 @@ walk_time = 10
 
 if res and res["coords"] == st.session_state["click_coords"]:
     has_data = True
-    raw_pois = res["pois"]
-    if raw_pois is not None and not raw_pois.empty:
-
-        def classify_poi(row):
-            amenity = row.get("amenity")
-            shop = row.get("shop")
-            railway = row.get("railway")
-            
-            if pd.notna(railway): return "Transit (Train/Rail)"
-            if pd.notna(row.get("public_transport")) or row.get("highway") == "bus_stop": return "Transit (Bus/Other)"
-            
-            if amenity in ['school', 'university', 'college', 'kindergarten', 'language_school']:
-                return "Education"
-            if amenity == 'place_of_worship':
-                return "Worship"
-            if amenity in ['clinic', 'hospital', 'pharmacy', 'doctors', 'dentist']:
-                return "Healthcare"
-            if pd.notna(row.get("healthcare")): return "Healthcare"
-            
-            if shop in ['supermarket', 'convenience', 'greengrocer', 'bakery', 'market']:
-                return "Grocery"
-            
-            if pd.notna(row.get("leisure")) or pd.notna(row.get("sport")): return "Leisure/Sport"
-            if pd.notna(row.get("tourism")): return "Tourism"
-            if pd.notna(row.get("office")): return "Office"
-            
-            return "Others"
-
-        raw_pois["main_category"] = raw_pois.apply(classify_poi, axis=1)
-        raw_pois["display_name"] = raw_pois["main_category"] + ": " + raw_pois["amenity"].fillna("Location")
-        pois_data = raw_pois
+    if res["pois"] is not None and not res["pois"].empty:
+        pois_data = res["pois"]
 
 # --- 5. SIDEBAR ---
 with st.sidebar:
     st.header("Settings")
-    walk_time = st.slider("Walking Time (minutes) at 4.5 km/h", 1, 15, 10)
+    walk_time = st.slider("Walking Time (minutes) at 4.5 km/h", 1, MAX_WALK_TIME_MIN, 10)
 
-    st.divider()
-    st.header("Filters")
 
-    if has_data and not pois_data.empty:
-        available_cats = sorted(pois_data["main_category"].unique().astype(str))
-        
+# Pill clicks rerun only this fragment; the map below is left untouched
+@st.fragment
+def render_dashboard(res, pois_data):
+    st.subheader("📊 Amenities Breakdown")
+
+    if not pois_data.empty:
+        available_cats = sorted(res["category_counts"])
+
         # --- BUTTONS ---
         col1, col2 = st.columns(2)
         if col1.button("Select All", use_container_width=True):
             st.session_state["selected_layers"] = available_cats
-            st.rerun()
-        
+            st.rerun(scope="fragment")
+
         if col2.button("Deselect All", use_container_width=True):
             st.session_state["selected_layers"] = []
-            st.rerun()
+            st.rerun(scope="fragment")
 
         # --- FIX FOR WARNING ---
         # 1. Initialize the state if it doesn't exist
         if "selected_layers" not in st.session_state:
             st.session_state["selected_layers"] = available_cats
-            
+
         # 2. Create widget WITHOUT default argument
         selected_layers = st.pills(
             "Toggle Categories:",
@@ -143,9 +309,27 @@ with st.sidebar:
             selection_mode="multi",
             key="selected_layers"  # Reads value from session state automatically
         )
+
+        if selected_layers:
+            counts = res["category_counts"]
+            spec = build_category_chart_spec(tuple(sorted((c, counts.get(c, 0)) for c in selected_layers)))
+            st.vega_lite_chart(spec, width="stretch")
+        else:
+            st.warning("No categories selected. Click 'Select All' above.")
     else:
-        st.info("Filters will appear after the analysis is complete.")
-        selected_layers = []
+        st.warning("No amenities found in this range.")
+
+    st.divider()
+    st.subheader("📏 Catchment Statistics")
+    total_length_km = res["edges"]["length"].sum() / 1000
+    
+    # Geodesic area straight from lon/lat, no UTM round-trip
+    area_sq_km = abs(_GEOD.geometry_area_perimeter(res["polygon"])[0]) / 1e6
+
+    m1, m2 = st.columns(2)
+    m1.metric("Isochrone Area", f"{area_sq_km:.2f} km²")
+    m2.metric("Street Network Length", f"{total_length_km:.2f} km")
+
 
 # --- 6. MAIN LAYOUT ---
 st.title("Walking Catchment Analyzer")
@@ -164,54 +348,7 @@ with col_dash:
             st.rerun()
 
     elif has_data:
-        st.subheader("📊 Amenities Breakdown")
-
-        if not pois_data.empty:
-            # Filter Data
-            chart_source = pois_data[pois_data["main_category"].isin(selected_layers)]
-
-            if not chart_source.empty:
-                chart_agg = chart_source["main_category"].value_counts().reset_index()
-                chart_agg.columns = ["Category", "Count"]
-
-                base = alt.Chart(chart_agg).encode(
-                    y=alt.Y("Category", sort="-x", title=None),
-                    tooltip=["Category", "Count"],
-                )
-                bars = base.mark_bar().encode(
-                    x=alt.X("Count", title="Count"),
-                    color=alt.Color(
-                        "Category",
-                        scale=alt.Scale(
-                            domain=list(color_map.keys()), range=list(color_map.values())
-                        ),
-                        legend=None,
-                    ),
-                )
-                text = base.mark_text(dx=5, align="left", color="#FFFFFF").encode(
-                    x=alt.X("Count"), text="Count"
-                )
-                final_chart = (bars + text).properties(height=350)
-                st.altair_chart(final_chart, width="stretch")
-            else:
-                st.warning("No categories selected. Click 'Select All' in the sidebar.")
-        else:
-            st.warning("No amenities found in this range.")
-
-        st.divider()
-        st.subheader("📏 Catchment Statistics")
-        total_length_km = res["edges"]["length"].sum() / 1000
-        
-        # Suppress area warning for dashboard metrics
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", UserWarning)
-            poly_gdf = gpd.GeoDataFrame(geometry=[res["polygon"]], crs="EPSG:4326")
-            poly_utm = poly_gdf.to_crs(poly_gdf.estimate_utm_crs())
-            area_sq_km = poly_utm.area[0] / 1e6 
-        
-        m1, m2 = st.columns(2)
-        m1.metric("Isochrone Area", f"{area_sq_km:.2f} km²")
-        m2.metric("Street Network Length", f"{total_length_km:.2f} km")
+        render_dashboard(res, pois_data)
 
     else:
         st.markdown(
@@ -231,11 +368,8 @@ with col_map:
     else:
         map_center = [-6.1754, 106.8272]
 
-    m = folium.Map(location=map_center, zoom_start=15, tiles=None)
-
-    folium.TileLayer(tiles="OpenStreetMap", name="Street Map", control=True).add_to(m)
-    folium.TileLayer(tiles="CartoDB positron", name="Light Map", control=True).add_to(m)
-    folium.TileLayer(tiles="CartoDB dark_matter", name="Dark Map", control=True).add_to(m)
+    m = copy.deepcopy(_base_map())
+    m.location = list(map_center)
     
 
     if st.session_state["click_coords"]:
@@ -270,21 +404,47 @@ with col_map:
         ).add_to(m)
 
         if not pois_data.empty:
-            fg = folium.FeatureGroup(name="Amenities")
-            final_filtered_data = pois_data[pois_data["main_category"].isin(selected_layers)]
-            for idx, row in final_filtered_data.iterrows():
-                if row.geometry.geom_type == "Point":
-                    loc = [row.geometry.y, row.geometry.x]
-                else:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore", UserWarning)
-                        loc = [row.geometry.centroid.y, row.geometry.centroid.x]
-                        
-                cat = row["main_category"]
-                color = color_map.get(cat, "gray")
-                radius = 7 if "Train" in cat else 5
-                folium.CircleMarker(loc, radius=radius, color=color, weight=0.5, fill=True, fill_color=color, fill_opacity=1, popup=row["display_name"]).add_to(fg)
-            fg.add_to(m)
+            # One overlay per category so Leaflet's layer control can toggle them client-side
+            pts = pois_data.geometry.representative_point()
+            lons, lats = pts.x.to_numpy(), pts.y.to_numpy()
+            cats = pois_data["main_category"].astype(object).to_numpy()
+            names = pois_data["display_name"].astype(str).to_numpy()
+            colors = _COLOR_SERIES.reindex(cats).fillna("gray").to_numpy()
+            radii = np.where(cats == _TRAIN_CAT, 7, 5)
+            use_clusters = len(cats) > FAST_CLUSTER_THRESHOLD
+
+            for cat in sorted(set(cats)):
+                idx = np.flatnonzero(cats == cat)
+                if use_clusters:
+                    FastMarkerCluster(data=np.column_stack([lats[idx], lons[idx]]).tolist(), name=cat).add_to(m)
+                    continue
+
+                # Plain GeoJSON dicts: one template render per layer instead of per marker
+                features = [
+                    {
+                        "type": "Feature",
+                        "geometry": {"type": "Point", "coordinates": [x, y]},
+                        "properties": {"name": name, "color": color, "r": r},
+                    }
+                    for x, y, name, color, r in zip(
+                        lons[idx].tolist(), lats[idx].tolist(), names[idx].tolist(),
+                        colors[idx].tolist(), radii[idx].tolist(),
+                    )
+                ]
+                folium.GeoJson(
+                    {"type": "FeatureCollection", "features": features},
+                    name=cat,
+                    marker=folium.CircleMarker(),
+                    style_function=lambda f: {
+                        "radius": f["properties"]["r"],
+                        "color": f["properties"]["color"],
+                        "fillColor": f["properties"]["color"],
+                        "fill": True,
+                        "fillOpacity": 1,
+                        "weight": 0.5,
+                    },
+                    popup=folium.GeoJsonPopup(fields=["name"], labels=False),
+                ).add_to(m)
 
     folium.LayerControl(position="topright").add_to(m)
     
@@ -305,7 +465,7 @@ with col_map:
         with st.status("⏳ Analyzing urban network...", expanded=True) as status:
             try:
                 st.write("Tracing street network...")
-                edges_gdf, query_poly = calculate_isochrone_network(lat, lon, walk_time)
+                query_poly = calculate_isochrone_polygon(lat, lon, walk_time)
                 st.write("Scanning amenities...")
                 tags = {
                     "amenity": True, "shop": True, "office": True,
@@ -314,19 +474,32 @@ with col_map:
                     "railway": ["station", "halt", "subway_entrance"],
                     "tourism": True,
                 }
-                pois = get_amenities(query_poly, tags, lat, lon)
+                # Overpass POI fetch runs on a worker thread while the edge frame is built
+                ctx = get_script_run_ctx()
+                with ThreadPoolExecutor(
+                    max_workers=1, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+                ) as executor:
+                    pois_future = executor.submit(get_amenities, query_poly.wkb, json.dumps(tags, sort_keys=True))
+                    edges_gdf = calculate_isochrone_edges(lat, lon, walk_time)
+                    pois = pois_future.result()
                 
                 if pois is not None and not pois.empty:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore", UserWarning)
-                        pois = pois[pois.geometry.centroid.within(query_poly)]
+                    # R-tree query over representative points; the hull "contains" each hit
+                    reps = pois.geometry.representative_point()
+                    hits = reps.sindex.query(query_poly, predicate="contains")
+                    pois = classify_pois(pois.iloc[np.sort(hits)])
                     
                     # Fix: Force reset the filters by removing the key
                     if "selected_layers" in st.session_state:
                         del st.session_state["selected_layers"]
 
+                category_counts = {}
+                if pois is not None and not pois.empty:
+                    category_counts = {c: int(n) for c, n in pois["main_category"].value_counts().items() if n > 0}
+
                 st.session_state["analysis_results"] = {
-                    "coords": (lat, lon), "walk_time": walk_time, "edges": edges_gdf, "pois": pois, "polygon": query_poly
+                    "coords": (lat, lon), "walk_time": walk_time, "edges": edges_gdf, "pois": pois, "polygon": query_poly,
+                    "category_counts": category_counts,
                 }
                 status.update(label="✅ Complete!", state="complete", expanded=False)
                 st.rerun()